@@ -1,13 +1,24 @@
+import gc
+import logging
+import socket
 import time
+import threading
+import orjson
 import requests
 import pandas as pd
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import lru_cache
 from io import BytesIO
 
 import streamlit as st
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font
-from openpyxl.utils.dataframe import dataframe_to_rows
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
 
 
 # ----------------------------------------------------------
@@ -16,6 +27,121 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 SERP_API_KEY = st.secrets["SERP_API_KEY"]
 ISBNDB_API_KEY = st.secrets["ISBNDB_API_KEY"]
 
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------
+# SHARED HTTP SESSION (KEEP-ALIVE POOL, THREAD-SAFE)
+# ----------------------------------------------------------
+# One global cap on in-flight HTTP requests, independent of how many
+# threads are orchestrating rows. The workload is almost pure network
+# waiting, so the ceiling is set by provider rate limits, not CPU —
+# override it in secrets.toml to match the SerpAPI/ISBNDB plan.
+MAX_INFLIGHT_REQUESTS = int(st.secrets.get("MAX_INFLIGHT_REQUESTS", 200))
+
+# Streamlit re-executes this script on every interaction, so the
+# session and thread pools live behind st.cache_resource — warm TLS
+# connections and spun-up threads survive reruns instead of being
+# rebuilt per click.
+
+
+def _cacheable_response(response):
+    # SerpAPI reports failures (rate limits included) in 200-status JSON
+    # bodies; persisting one would replay the failure for the full TTL.
+    if "serpapi.com" in response.url:
+        try:
+            return "error" not in orjson.loads(response.content)
+        except ValueError:
+            return False
+    return True
+
+
+# Responses are also cached on disk for a week, so re-running the same
+# sheet (or overlapping sheets) across sessions skips the paid APIs
+# entirely. requests-cache's default ignored_parameters already strip
+# api_key from cache keys and redact the Authorization header before
+# anything is persisted.
+@st.cache_resource
+def get_session():
+    session = CachedSession(
+        "isbn_cache.sqlite",
+        backend="sqlite",
+        expire_after=604800,
+        allowable_methods=["GET"],
+        stale_if_error=True,
+        filter_fn=_cacheable_response,
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=MAX_INFLIGHT_REQUESTS,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+            ),
+        ),
+    )
+    session.headers.update({"Accept-Encoding": "gzip"})
+    return session
+
+
+# Pool for the per-ISBN rows.
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(
+        max_workers=MAX_INFLIGHT_REQUESTS, thread_name_prefix="isbn"
+    )
+
+
+# Dedicated pool for per-call fan-out (leaf HTTP requests only, so it
+# can never deadlock against the per-ISBN pool).
+@st.cache_resource
+def get_fetch_executor():
+    return ThreadPoolExecutor(
+        max_workers=MAX_INFLIGHT_REQUESTS, thread_name_prefix="fetch"
+    )
+
+
+SESSION = get_session()
+_FETCH_EXECUTOR = get_fetch_executor()
+
+_HTTP_SEM = threading.BoundedSemaphore(MAX_INFLIGHT_REQUESTS)
+
+
+# ----------------------------------------------------------
+# DNS CACHE FOR THE FIXED API HOSTS
+# ----------------------------------------------------------
+# urllib3 resolves the hostname for every new connection; we only ever
+# talk to three hosts, so resolve each at most once per TTL window.
+_DNS_CACHED_HOSTS = frozenset(["serpapi.com", "api2.isbndb.com", "www.googleapis.com"])
+_DNS_TTL = 300
+
+
+def _install_dns_cache():
+    if getattr(socket.getaddrinfo, "_isbn_dns_cache", False):
+        return
+
+    resolve = socket.getaddrinfo
+
+    @lru_cache(maxsize=64)
+    def _cached(host, port, family, type, proto, flags, ttl_bucket):
+        return resolve(host, port, family, type, proto, flags)
+
+    def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        if host in _DNS_CACHED_HOSTS:
+            bucket = int(time.monotonic() // _DNS_TTL)
+            return _cached(host, port, family, type, proto, flags, bucket)
+        return resolve(host, port, family, type, proto, flags)
+
+    getaddrinfo._isbn_dns_cache = True
+    socket.getaddrinfo = getaddrinfo
+
+
+_install_dns_cache()
+
 
 # ----------------------------------------------------------
 # COLOR MAP FOR EXCEL
@@ -26,29 +152,52 @@ COLOR_MAP = {
     "google": Font(color="FACC15"),
 }
 
+OUTPUT_COLUMNS = (
+    "ISBN",
+    "title",
+    "author",
+    "publisher",
+    "binding",
+    "edition",
+    "number_of_pages",
+    "category",
+    "price",
+    "amazon_domain_used",
+    "serp_api_calls",
+    "source_used",
+)
+
 
 # ----------------------------------------------------------
-# AUTOSAVE INTO EXCEL (IN MEMORY)
+# STREAMING EXCEL WRITER (IN MEMORY)
 # ----------------------------------------------------------
-def save_partial_excel(results, color_results):
-    wb = Workbook()
-    ws = wb.active
-
-    df_out = pd.DataFrame(results)
-
-    for r_idx, row_data in enumerate(
-        dataframe_to_rows(df_out, index=False, header=True), 1
-    ):
-        ws.append(row_data)
-
-        if r_idx == 1:
-            continue
-
-        for c_idx, col_name in enumerate(df_out.columns, 1):
-            src = color_results[r_idx - 2].get(col_name)
-            if src in COLOR_MAP:
-                ws.cell(r_idx, c_idx).font = COLOR_MAP[src]
-
+# Write-only mode streams rows straight to the file, so memory stays
+# flat no matter how many ISBNs are in the sheet.
+def start_output_workbook():
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(OUTPUT_COLUMNS)
+    return wb, ws
+
+
+def append_result_row(ws, row, row_colors):
+    # Rows with no coloured fields don't need styling, so append the
+    # plain values and skip building a WriteOnlyCell per column.
+    if not any(src in COLOR_MAP for src in row_colors.values()):
+        ws.append([row[col_name] for col_name in OUTPUT_COLUMNS])
+        return
+
+    cells = []
+    for col_name in OUTPUT_COLUMNS:
+        cell = WriteOnlyCell(ws, value=row[col_name])
+        src = row_colors.get(col_name)
+        if src in COLOR_MAP:
+            cell.font = COLOR_MAP[src]
+        cells.append(cell)
+    ws.append(cells)
+
+
+def finish_output_workbook(wb):
     stream = BytesIO()
     wb.save(stream)
     stream.seek(0)
@@ -59,24 +208,52 @@ def save_partial_excel(results, color_results):
 # HELPERS
 # ----------------------------------------------------------
 def is_missing(x):
-    return x is None or str(x).strip() == ""
+    # Upstream JSON values are already strings or None, so avoid the
+    # str()/strip() round-trip for the common cases.
+    return x is None or x == "" or (isinstance(x, str) and not x.strip())
 
 
 # ----------------------------------------------------------
 # SERP FETCH
 # ----------------------------------------------------------
+_SERP_URL = "https://serpapi.com/search.json"
+_SERP_BASE_PARAMS = {
+    "engine": "amazon",
+    "api_key": SERP_API_KEY,
+    # We only ever read the first result's title and price, so ask
+    # SerpAPI to strip everything else (keeping "error" visible for the
+    # in-body rate-limit handling below). Cuts response bodies from tens
+    # of KB to a few hundred bytes. Slice addressing is the form the
+    # json_restrictor docs show.
+    "json_restrictor": "error,organic_results[0:1].{title,price}",
+}
+
+
 def serp_fetch(isbn, domain):
     try:
-        url = "https://serpapi.com/search.json"
-        params = {
-            "engine": "amazon",
-            "amazon_domain": domain,
-            "api_key": SERP_API_KEY,
-            "k": isbn
-        }
+        params = {**_SERP_BASE_PARAMS, "amazon_domain": domain, "k": isbn}
+
+        for attempt in range(2):
+            with _HTTP_SEM:
+                res = SESSION.get(_SERP_URL, params=params, timeout=10)
+            data = orjson.loads(res.content)
+
+            error = data.get("error")
+            if not error:
+                break
+
+            # SerpAPI reports rate limiting inside a 200 JSON body,
+            # which the adapter-level Retry never sees. Drop any cached
+            # copy of the error first, so the retry (and later runs) hit
+            # the network instead of replaying it.
+            SESSION.cache.delete(urls=[res.url])
+            if attempt == 0 and "rate" in error.lower():
+                time.sleep(0.5)
+                continue
+
+            logger.warning("SerpAPI error for %s on %s: %s", isbn, domain, error)
+            return {}
 
-        res = requests.get(url, params=params, timeout=10)
-        data = res.json()
         results = data.get("organic_results", [])
 
         if not results:
@@ -91,23 +268,34 @@ def serp_fetch(isbn, domain):
             "price": price
         }
 
-    except:
+    except (requests.RequestException, ValueError):
         return {}
 
 
 SERP_PRIORITY = ["amazon.in", "amazon.com", "amazon.co.uk", "amazon.de"]
 
 
-def get_serp_sequential(isbn):
+def get_serp_data(isbn):
     final = {"title": None, "price": None}
     colors = {}
     domain_used = None
-    serp_calls = 0
+
+    # Fire all domains at once, then consume the answers in priority
+    # order — latency becomes the max of the useful calls instead of
+    # their sum.
+    futures = {
+        domain: _FETCH_EXECUTOR.submit(serp_fetch, isbn, domain)
+        for domain in SERP_PRIORITY
+    }
+    cancelled = 0
 
     for domain in SERP_PRIORITY:
-        serp_calls += 1
+        if final["title"] and final["price"]:
+            if futures[domain].cancel():
+                cancelled += 1
+            continue
 
-        data = serp_fetch(isbn, domain)
+        data = futures[domain].result()
         if not data:
             continue
 
@@ -128,25 +316,25 @@ def get_serp_sequential(isbn):
             colors["price"] = "serp"
             domain_used = domain
 
-        if final["title"] and final["price"]:
-            break
-
-    return final, colors, domain_used, serp_calls
+    return final, colors, domain_used, len(SERP_PRIORITY) - cancelled
 
 
 # ----------------------------------------------------------
 # ISBNDB FETCH
 # ----------------------------------------------------------
+_ISBNDB_PREFIX = "https://api2.isbndb.com/book/"
+_ISBNDB_HEADERS = {"Authorization": ISBNDB_API_KEY}
+
+
 def get_isbndb_data(isbn):
     try:
-        url = f"https://api2.isbndb.com/book/{isbn}"
-        headers = {"Authorization": ISBNDB_API_KEY}
-        r = requests.get(url, headers=headers, timeout=10)
+        with _HTTP_SEM:
+            r = SESSION.get(_ISBNDB_PREFIX + str(isbn), headers=_ISBNDB_HEADERS, timeout=10)
 
         if r.status_code != 200:
             return {}, {}
 
-        b = r.json().get("book", {})
+        b = orjson.loads(r.content).get("book", {})
 
         data = {
             "title": b.get("title"),
@@ -161,19 +349,22 @@ def get_isbndb_data(isbn):
 
         return data, {k: "isbndb" for k, v in data.items() if not is_missing(v)}
 
-    except:
+    except (requests.RequestException, ValueError):
         return {}, {}
 
 
 # ----------------------------------------------------------
 # GOOGLE BOOKS FETCH
 # ----------------------------------------------------------
+_GOOGLE_PREFIX = "https://www.googleapis.com/books/v1/volumes?q=isbn:"
+
+
 def get_google_books_data(isbn):
     try:
-        url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
-        r = requests.get(url, timeout=10)
-        data = r.json()
-    except:
+        with _HTTP_SEM:
+            r = SESSION.get(_GOOGLE_PREFIX + str(isbn), timeout=10)
+        data = orjson.loads(r.content)
+    except (requests.RequestException, ValueError):
         return {}, {}
 
     if "items" not in data:
@@ -196,47 +387,56 @@ def get_google_books_data(isbn):
 # ----------------------------------------------------------
 # PROCESS SINGLE ISBN
 # ----------------------------------------------------------
-def process_single_isbn(isbn):
-    row = {
-        "ISBN": isbn,
-        "title": None,
-        "author": None,
-        "publisher": None,
-        "binding": None,
-        "edition": None,
-        "number_of_pages": None,
-        "category": None,
-        "price": None,
-        "amazon_domain_used": None,
-        "serp_api_calls": None,
-        "source_used": None
-    }
+def process_single_isbn(isbn, sufficient_fields=()):
+    missing = is_missing  # local alias, called ~30x per row
+
+    row = dict.fromkeys(OUTPUT_COLUMNS)
+    row["ISBN"] = isbn
 
     row_color = {"ISBN": None}
 
+    # With sufficient_fields set, the fallback providers are only fired
+    # after SERP reports back, so a complete SERP hit skips them (and
+    # their API cost) entirely. Otherwise fire them up front so they
+    # overlap with SERP; the merge keeps the same source priority either
+    # way.
+    isbndb_future = google_future = None
+    if not sufficient_fields:
+        isbndb_future = _FETCH_EXECUTOR.submit(get_isbndb_data, isbn)
+        google_future = _FETCH_EXECUTOR.submit(get_google_books_data, isbn)
+
     # SERP
-    serp_data, serp_colors, used_domain, serp_calls = get_serp_sequential(isbn)
+    serp_data, serp_colors, used_domain, serp_calls = get_serp_data(isbn)
     row["amazon_domain_used"] = used_domain
     row["serp_api_calls"] = serp_calls
 
     for k, v in serp_data.items():
-        if not is_missing(v):
+        if not missing(v):
             row[k] = v
             row_color[k] = serp_colors.get(k)
 
-    # ISBNDB
-    isbndb_data, c2 = get_isbndb_data(isbn)
-    for k, v in isbndb_data.items():
-        if is_missing(row[k]) and not is_missing(v):
-            row[k] = v
-            row_color[k] = c2.get(k)
-
-    # Google Books
-    google_data, c3 = get_google_books_data(isbn)
-    for k, v in google_data.items():
-        if is_missing(row[k]) and not is_missing(v):
-            row[k] = v
-            row_color[k] = c3.get(k)
+    skip_fallbacks = sufficient_fields and all(
+        not missing(row[f]) for f in sufficient_fields
+    )
+
+    if not skip_fallbacks:
+        if isbndb_future is None:
+            isbndb_future = _FETCH_EXECUTOR.submit(get_isbndb_data, isbn)
+            google_future = _FETCH_EXECUTOR.submit(get_google_books_data, isbn)
+
+        # ISBNDB
+        isbndb_data, c2 = isbndb_future.result()
+        for k, v in isbndb_data.items():
+            if missing(row[k]) and not missing(v):
+                row[k] = v
+                row_color[k] = c2.get(k)
+
+        # Google Books
+        google_data, c3 = google_future.result()
+        for k, v in google_data.items():
+            if missing(row[k]) and not missing(v):
+                row[k] = v
+                row_color[k] = c3.get(k)
 
     used_sources = set([v for v in row_color.values() if v])
     row["source_used"] = ", ".join(sorted(used_sources)) if used_sources else None
@@ -253,30 +453,73 @@ st.write("Upload an Excel file containing an **ISBN** column.")
 uploaded = st.file_uploader("Upload Excel", type=["xlsx"])
 
 if uploaded:
-    df = pd.read_excel(uploaded)
+    # calamine parses xlsx far faster than the default openpyxl reader
+    # and with a much smaller peak footprint.
+    df = pd.read_excel(uploaded, engine="calamine")
     st.write("### Preview Input File:")
     st.dataframe(df.head())
 
-    if st.button("🚀 Start Processing"):
-        results = []
-        color_results = []
+    bypass_cache = st.checkbox("Bypass response cache (force fresh API calls)")
 
+    # Opt-in cost saver: skipping the fallbacks leaves the fields only
+    # they provide (author, publisher, binding, pages, category) blank,
+    # so all sources are queried unless the user selects fields here.
+    sufficient_fields = st.multiselect(
+        "Skip ISBNDB/Google Books once SERP has filled these fields "
+        "(leave empty to always query all sources)",
+        ["title", "price", "author"],
+        default=[],
+    )
+
+    # Clean the ISBN column once up front instead of per-row later:
+    # stringify, strip whitespace and drop blanks/NaN.
+    isbns = df["ISBN"].dropna().astype(str).str.strip()
+    isbns = isbns[isbns != ""].tolist()
+
+    if st.button("🚀 Start Processing"):
         progress = st.progress(0)
         status = st.empty()
 
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            futures = {executor.submit(process_single_isbn, isbn): isbn for isbn in df["ISBN"]}
+        cache_ctx = SESSION.cache_disabled() if bypass_cache else nullcontext()
 
+        wb, ws = start_output_workbook()
+
+        # Each unique ISBN is fetched once; duplicates are written out
+        # as extra copies of the same result row.
+        counts = Counter(isbns)
+        unique_isbns = list(counts)
+
+        # Each progress/status call is a WebSocket round-trip; cap the
+        # updates at ~200 per run instead of one per ISBN.
+        update_every = max(1, len(unique_isbns) // 200)
+
+        executor = get_executor()
+
+        with cache_ctx:
+            futures = {
+                executor.submit(process_single_isbn, isbn, tuple(sufficient_fields)): isbn
+                for isbn in unique_isbns
+            }
+
+            written = 0
             for i, future in enumerate(as_completed(futures), 1):
                 row, row_color = future.result()
-                results.append(row)
-                color_results.append(row_color)
 
-                progress.progress(i / len(df))
-                status.write(f"Processed {i}/{len(df)} ISBNs")
+                # Each completed row goes straight into the workbook so
+                # nothing accumulates in Python lists.
+                for _ in range(counts[futures[future]]):
+                    append_result_row(ws, row, row_color)
+                written += counts[futures[future]]
+
+                if i % 1000 == 0:
+                    gc.collect()
+
+                if i % update_every == 0 or i == len(unique_isbns):
+                    progress.progress(written / len(isbns))
+                    status.write(f"Processed {written}/{len(isbns)} ISBNs")
 
         # Final Excel
-        excel_data = save_partial_excel(results, color_results)
+        excel_data = finish_output_workbook(wb)
 
         st.success("Processing complete!")
 